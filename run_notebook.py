@@ -12,7 +12,7 @@ Requirements:
 
 Steps:
 - run notebook based on input YAML
-- OR watch folder for files
+- OR watch folder for files (using watchfiles)
 - read parameters
 - create output notebook name/path
 - run notebook
@@ -26,24 +26,61 @@ https://linux.die.net/man/5/incrontab
 
 """
 import argparse
+import glob
+import hashlib
+import io
+import json
 import logging
-import re
+import multiprocessing
+import multiprocessing.util
+import os
 import uuid
-from dataclasses import dataclass, asdict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import cached_property, lru_cache, partial
+from itertools import groupby
+from logging.handlers import QueueHandler, QueueListener
+from operator import attrgetter
 from pathlib import Path
 import shutil
-from time import sleep
-from typing import Any, Dict, Union
+import signal
+from time import monotonic, sleep, time
+from typing import Any, Dict, NamedTuple, Optional, Set, Tuple, Union
 
 import papermill as pm
 import scrapbook as sb
 import yaml
+from watchfiles import Change, watch
 import nbformat
+from jupyter_client import BlockingKernelClient, KernelManager
 from nbconvert import HTMLExporter
+from papermill.clientwrap import PapermillNotebookClient
+from papermill.engines import NBClientEngine, papermill_engines
+from papermill.log import logger as pm_logger
+from papermill.utils import merge_kwargs, remove_args
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 _LOG_FILE_NAME = "run_notebook.log"
+_PARAMS_CACHE_FOLDER = ".cache"
+_PARAMS_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+_PARAMS_CACHE_PRUNE_INTERVAL = 60 * 60
+# monotonic time after which this process next prunes the params cache
+_NEXT_CACHE_PRUNE = 0.0
+_SETTLED_WRITE_SECS = 2
+_MAX_READ_BUFFER = 1 << 20
+_COPY_CHUNK_SIZE = 1 << 20
+_HTML_CHUNK_SIZE = 1 << 20
+_JOB_TIME_FORMAT = "%Y-%m-%dT%H-%M-%S-%f+00-00"
+_JOB_TIME_LEN = len("2022-08-16T17-29-13-165160+00-00")
+# limit on previous runs of a job checked for a matching completed job
+_MAX_COMPLETED_JOB_CHECKS = 20
+_OUTPUT_DIV_FORMATS = {"y": "%Y", "m": "%Y/%m", "d": "%Y/%m/%d", "h": "%Y/%m/%d/%H"}
+_UNSAFE_FN_CHARS = str.maketrans(dict.fromkeys('<>:"/\\|?*', "-"))
 
 
 @dataclass
@@ -116,6 +153,11 @@ class NotebookJob:
         self.job_file = job_file
         self.nb = None
         _validate_params(global_args, self.nb_params)
+        self._working_file_str = str(self.nb_params.working_file)
+        self._job_dst = os.path.join(
+            os.path.dirname(self._working_file_str),
+            f"{os.path.splitext(self.output_notebook)[0]}.job",
+        )
 
     def run(self):
         """Run the job."""
@@ -126,24 +168,21 @@ class NotebookJob:
             self.input_file_path,
             self.output_file_path,
             self.nb_params,
+            kernel_reuse=self._global_args.kernel_reuse,
         )
         self._check_for_findings()
-        Path(self.nb_params.working_file).rename(
-            Path(self.nb_params.working_file)
-            .parent.joinpath(self.output_notebook)
-            .with_suffix(".job")
-        )
+        os.replace(self._working_file_str, self._job_dst)
 
         self.log_info(
             f"Job run complete: {self.input_notebook} ({self.output_notebook})."
         )
 
-    @property
+    @cached_property
     def input_file_path(self):
         """Return name of notebook to execute."""
         return Path(self.nb_path).joinpath(self.input_notebook)
 
-    @property
+    @cached_property
     def output_file_path(self):
         """Return name of notebook to execute."""
         return Path(self.output_path).joinpath(self.output_notebook)
@@ -153,73 +192,58 @@ class NotebookJob:
         """Return name of notebook to execute."""
         return self.nb_params.notebook
 
-    @property
+    @cached_property
     def output_notebook(self):
         """Return an output filename."""
         notebook_name = Path(self.nb_params.notebook).stem
         return f"{notebook_name}-{self.nb_params.identifier}-{self.job_time}.ipynb"
 
-    @property
+    @cached_property
     def job_time(self):
-        """Return current time formatted for filename compatibility."""
-        return re.sub("[:.]", "-", self.start_time.isoformat())
+        """Return job start time formatted for filename compatibility."""
+        # start_time is always UTC
+        return self.start_time.strftime(_JOB_TIME_FORMAT)
 
     def read_params(self, file_path) -> NotebookParams:
         """Read the parameters file and return PM and exec parameters."""
-        working_file = Path(file_path).with_name(f"{self.job_id}.tmp")
-        Path(file_path).rename(working_file)
-        yaml_text = Path(working_file).read_text(encoding="utf-8")
-        params = yaml.safe_load(yaml_text)
-
-        papermill_params = params.get("papermill")
-        exec_params = params.get("exec", {})
-        identifiers = exec_params.get("identifier", "")
-        if isinstance(identifiers, str):
-            identifiers = [identifiers]
-        identifier = "-".join(papermill_params.get(param, "") for param in identifiers)
-        identifier = _safe_file_name(identifier.replace("--", "-"))
+        source_file = Path(file_path)
+        working_file = source_file.with_name(f"{self.job_id}.inprogress")
+        # claim the job - atomic, so only one worker can succeed
+        os.replace(source_file, working_file)
+        params = _read_cached_params(
+            working_file, Path(self.queue_path, _PARAMS_CACHE_FOLDER)
+        )
 
         return NotebookParams(
-            papermill=papermill_params,
-            exec_params=exec_params,
-            identifier=identifier,
-            source_file=Path(file_path),
+            papermill=params.get("papermill"),
+            exec_params=params.get("exec", {}),
+            identifier=_job_identifier(params),
+            source_file=source_file,
             working_file=working_file,
             job_id=self.job_id,
         )
 
     def _get_output_folder_path(self, root: Union[str, Path], division: str):
-        date_parts = {
-            "y": self.start_time.strftime("%Y"),
-            "m": self.start_time.strftime("%m"),
-            "d": self.start_time.strftime("%d"),
-            "h": self.start_time.strftime("%H"),
-        }
-
-        folder_path = []
-        for part, date_str in date_parts.items():
-            folder_path.append(date_str)
-            if division.casefold() == part:
-                break
-
-        out_path = Path(root).joinpath("/".join(folder_path))
-        if not out_path.is_dir():
-            out_path.mkdir(parents=True)
-        return out_path
+        out_path = _output_folder(root, division, self.start_time)
+        os.makedirs(out_path, exist_ok=True)
+        return Path(out_path)
 
     def _check_for_findings(self):
-        nb = sb.read_notebook(str(self.output_file_path))
+        # most notebooks have no findings - look for the scrap in the
+        # executed notebook before loading it with scrapbook
+        if not _has_scrap(self.nb, "Findings"):
+            return
+        nb = sb.read_notebook(self.nb)
         if nb.scraps.get("Findings"):
             self.log_info(f"Notebook has findings: {self.output_file_path}.")
             findings_folder = Path(self._global_args.findings_path)
             if not findings_folder.is_dir():
                 findings_folder.mkdir(parents=True)
+            findings_nb = findings_folder.joinpath(self.output_file_path.name)
             self.log_info(f"Creating notebook copy in {findings_folder}.")
-            shutil.copy(self.output_file_path, findings_folder)
+            _link_or_copy(self.output_file_path, findings_nb)
             self.log_info(f"Creating html copy in {findings_folder}.")
-            _notebook_to_html(
-                Path(findings_folder).joinpath(self.output_file_path.name)
-            )
+            _notebook_to_html(findings_nb, nb.node)
 
     def log_info(self, message):
         """Log an information message."""
@@ -228,117 +252,521 @@ class NotebookJob:
 
 def main(global_args):
     """Run main loop for NB processing."""
-    _start_logging(global_args.log_path)
+    log_listener = _start_logging(global_args.log_path)
     logging.info("====================")
     logging.info("run_notebook started")
-    _watch_for_jobs(global_args)
-    logging.info("run_notebook ended")
+    try:
+        executor = ProcessPoolExecutor(
+            max_workers=global_args.workers,
+            initializer=_init_worker,
+            initargs=(log_listener.queue,),
+        )
+        try:
+            _watch_for_jobs(global_args, executor)
+        finally:
+            # let running jobs finish but drop any that have not started
+            executor.shutdown(wait=True, cancel_futures=True)
+        logging.info("run_notebook ended")
+    finally:
+        log_listener.stop()
 
 
 def create_folders(global_args):
     """Create folders for notebook runs."""
-    Path(global_args.nb_path).mkdir(parents=True, exist_ok=True)
-    Path(global_args.log_path).mkdir(parents=True, exist_ok=True)
-    Path(global_args.output_path).mkdir(parents=True, exist_ok=True)
-    Path(global_args.queue_path).mkdir(parents=True, exist_ok=True)
-    Path(global_args.findings_path).mkdir(parents=True, exist_ok=True)
-    Path(global_args.config_path).mkdir(parents=True, exist_ok=True)
+    for folder in (
+        global_args.nb_path,
+        global_args.log_path,
+        global_args.output_path,
+        global_args.queue_path,
+        global_args.findings_path,
+        global_args.config_path,
+    ):
+        # log_path is optional (defaults to None)
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+
+def _start_logging(log_path: Union[str, Path]) -> QueueListener:
+    """
+    Start logging to file.
 
+    Returns
+    -------
+    QueueListener
+        The listener that writes queued log records to the log file.
+        Worker processes log to the listener's queue (see `_log_to_queue`).
 
-def _start_logging(log_path: Union[str, Path]):
-    """Start logging to file."""
+    """
     if log_path is not None:
         if not Path(log_path).is_dir():
             Path(log_path).mkdir(parents=True)
-        log_file = Path(log_path).joinpath(_LOG_FILE_NAME)
+        log_handler: logging.Handler = logging.FileHandler(
+            Path(log_path).joinpath(_LOG_FILE_NAME), encoding="utf-8"
+        )
     else:
-        log_file = None
-    logging.basicConfig(
-        filename=log_file,
-        encoding="utf-8",
-        level=logging.INFO,
-        format="%(asctime)s: %(levelname)s - %(message)s",
+        log_handler = logging.StreamHandler()
+    log_handler.setFormatter(
+        logging.Formatter("%(asctime)s: %(levelname)s - %(message)s")
+    )
+    log_listener = QueueListener(multiprocessing.Queue(-1), log_handler)
+    log_listener.start()
+    _log_to_queue(log_listener.queue)
+    return log_listener
+
+
+def _log_to_queue(log_queue):
+    """Send log records from this process to `log_queue`."""
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    # watchfiles logs every batch of changes at INFO level
+    logging.getLogger("watchfiles").setLevel(logging.WARNING)
+
+
+def _init_worker(log_queue):
+    """Initialize a job worker process."""
+    # Ctrl-C is handled by the main process, which lets running jobs
+    # finish before shutting down the worker pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _log_to_queue(log_queue)
+    # atexit handlers are not run in worker processes - shut down
+    # pooled kernels using a multiprocessing finalizer instead
+    multiprocessing.util.Finalize(None, _shutdown_kernel_pool, exitpriority=10)
+
+
+def _watch_for_jobs(global_args, executor: Executor):
+    """Watch the queue folder for jobs to execute."""
+    # watchfiles reports absolute paths - use the same form for
+    # rescanned jobs so that they match those already submitted
+    queue_folder = Path(global_args.queue_path).resolve()
+    check_interval = float(global_args.check_interval)
+    # jobs submitted to the executor that have not yet finished
+    submitted: Set[Path] = set()
+
+    # pick up any jobs queued before we started watching
+    _run_jobs(
+        global_args,
+        _find_queued_jobs(queue_folder),
+        executor,
+        submitted,
+        startup=True,
     )
+    last_scan = monotonic()
+    logging.info("Watching for jobs in %s", queue_folder)
+    for changes in watch(
+        queue_folder,
+        # only job files at the top level of the queue folder are run
+        recursive=False,
+        step=50,
+        rust_timeout=int(check_interval * 1000),
+        yield_on_timeout=True,
+        raise_interrupt=False,
+    ):
+        jobs = [
+            Path(path)
+            for change, path in changes
+            if change == Change.added and path.endswith(".yaml")
+        ]
+        if monotonic() - last_scan >= check_interval:
+            # housekeeping - rescan for any files missed by the watcher
+            jobs.extend(
+                job for job in _find_queued_jobs(queue_folder) if job not in jobs
+            )
+            last_scan = monotonic()
+        try:
+            _run_jobs(global_args, jobs, executor, submitted)
+        except KeyboardInterrupt:
+            break
+    logging.info("Shutdown requested")
+
+
+def _find_queued_jobs(queue_folder: Path):
+    """Return the job files currently in the queue folder."""
+    with os.scandir(queue_folder) as entries:
+        return [
+            Path(entry.path)
+            for entry in entries
+            if entry.name.endswith(".yaml") and entry.is_file()
+        ]
+
+
+def _run_jobs(
+    global_args,
+    jobs,
+    executor: Executor,
+    submitted: Set[Path],
+    startup: bool = False,
+):
+    """Submit each of the job files in `jobs` to a worker process."""
+    for job in jobs:
+        # check for jobs already submitted or locked before waiting
+        # for the file size to settle
+        if job in submitted:
+            continue
+        # locks with our process ID can only be left over from an earlier
+        # watcher that had the same ID before we have submitted anything
+        if _is_locked(job, reclaim_own=startup and not submitted):
+            continue
+        if not _is_write_complete(job) or not _lock_job(job):
+            continue
+        completed_nb = _find_completed_job(global_args, job)
+        if completed_nb:
+            logging.info("Skipping complete job %s (%s)", job.name, completed_nb)
+            job.unlink()
+            _unlock_job(job)
+            continue
+        logging.info("Job queued: %s", job.name)
+        submitted.add(job)
+        executor.submit(_run_job_entry, global_args, job).add_done_callback(
+            partial(_job_done, job=job, submitted=submitted)
+        )
+
+
+def _job_done(future: Future, job: Path, submitted: Set[Path]):
+    """Handle completion (or cancellation) of a submitted job."""
+    submitted.discard(job)
+    if future.cancelled():
+        # never started - leave the job file to be picked up next time
+        _unlock_job(job)
+
 
+def _run_job_entry(global_args, job_file: Path):
+    """Create and run a notebook job - executed in a worker process."""
+    try:
+        if not job_file.is_file():
+            # already picked up by another watcher
+            return
+        logging.info("Job created")
+        try:
+            nb_job = NotebookJob(global_args, job_file)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.error("Exception creating job %s", job_file, exc_info=err)
+            return
+        try:
+            nb_job.run()
+        except Exception as err:  # pylint: disable=broad-except
+            logging.error(
+                "Exception while running job (notebook %s, job %s)",
+                nb_job.input_notebook,
+                nb_job.job_id,
+                exc_info=err,
+            )
+        logging.info("Job complete")
+    finally:
+        _unlock_job(job_file)
+
+
+def _lock_job(job_file: Path) -> bool:
+    """Create a lock file for the job, return False if already locked."""
+    try:
+        lock_fd = os.open(
+            job_file.with_suffix(".lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+        )
+    except FileExistsError:
+        return False
+    try:
+        os.write(lock_fd, str(os.getpid()).encode())
+    finally:
+        os.close(lock_fd)
+    return True
 
-def _watch_for_jobs(global_args):
-    """Enter a loop looking for jobs to execute."""
-    queue_folder = Path(global_args.queue_path)
 
-    while True:
-        jobs = list(queue_folder.glob("*.yaml"))
-        for job in jobs:
-            if not job.is_file():
+def _is_locked(job_file: Path, reclaim_own: bool = False) -> bool:
+    """
+    Return True if the job is locked by a running watcher.
+
+    Notes
+    -----
+    The lock file holds the process ID of the watcher that created it.
+    Locks left behind by a watcher that is no longer running are
+    removed. If `reclaim_own` is True, locks with this process's ID
+    are also removed - this is only safe before this process has
+    submitted any jobs.
+
+    """
+    lock_file = job_file.with_suffix(".lock")
+    try:
+        owner = lock_file.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return False
+    except OSError:
+        owner = ""
+    if owner.isdigit() and (
+        (reclaim_own and int(owner) == os.getpid()) or not _process_exists(int(owner))
+    ):
+        logging.warning(
+            "Removing stale lock for job %s (left by process %s)",
+            job_file.name,
+            owner,
+        )
+        lock_file.unlink(missing_ok=True)
+        return False
+    logging.info(
+        "Skipping job %s - locked by process %s", job_file.name, owner or "unknown"
+    )
+    return True
+
+
+def _process_exists(pid: int) -> bool:
+    """Return True if a process with ID `pid` is running."""
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows - assume running
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists but is owned by another user
+        return True
+    return True
+
+
+def _unlock_job(job_file: Path):
+    """Remove the lock file for the job."""
+    job_file.with_suffix(".lock").unlink(missing_ok=True)
+
+
+def _find_completed_job(global_args, job_file: Path) -> Optional[Path]:
+    """
+    Return the output notebook of a previous run of this job, if any.
+
+    A job is complete if there is a .job file in the queue folder with
+    the same parameters and its output notebook exists and is not empty.
+    The output notebook is looked for in the date folder given by the
+    current --output-div, so jobs run with a different division are
+    not found (and will be run again). Only the most recent
+    `_MAX_COMPLETED_JOB_CHECKS` matching .job files are checked.
+
+    """
+    try:
+        params = _read_yaml(job_file)
+        notebook = params.get("exec", {}).get("notebook")
+        prefix = f"{Path(notebook).stem}-{_job_identifier(params)}-"
+    except (OSError, yaml.YAMLError, AttributeError, TypeError):
+        # let the job fail and report the error when it is run
+        return None
+    done_jobs = sorted(
+        Path(global_args.queue_path).glob(f"{glob.escape(prefix)}*.job"),
+        # newest first - names end with the job start time
+        key=lambda done_job: done_job.stem[-_JOB_TIME_LEN:],
+        reverse=True,
+    )
+    for done_job in done_jobs[:_MAX_COMPLETED_JOB_CHECKS]:
+        try:
+            if _read_yaml(done_job) != params:
                 continue
-            logging.info("Job created")
-            nb_job = NotebookJob(global_args, job)
+            # the output notebook is in the date folder for the job start time
+            start_time = datetime.strptime(
+                done_job.stem[-_JOB_TIME_LEN:], _JOB_TIME_FORMAT
+            )
+            output_nb = Path(
+                _output_folder(
+                    global_args.output_path, global_args.output_div, start_time
+                ),
+                f"{done_job.stem}.ipynb",
+            )
+            if output_nb.stat().st_size:
+                return output_nb
+        except (OSError, ValueError, yaml.YAMLError):
+            # removed since the glob, unreadable or not a run_notebook .job
+            continue
+    return None
+
+
+def _output_folder(root: Union[str, Path], division: str, start_time: datetime) -> str:
+    """Return the output folder for a job started at `start_time`."""
+    # unrecognized divisions fall through to the finest (hour) division
+    folder_fmt = _OUTPUT_DIV_FORMATS.get(division.casefold(), "%Y/%m/%d/%H")
+    return os.path.join(root, start_time.strftime(folder_fmt))
+
+
+def _is_write_complete(job_file: Path, retries: int = 20) -> bool:
+    """Return True once the job file exists and its size has stopped changing."""
+    try:
+        job_stat = job_file.stat()
+        size = job_stat.st_size
+        if size and time() - job_stat.st_mtime > _SETTLED_WRITE_SECS:
+            # not modified recently - no need to wait
+            return True
+        for _ in range(retries):
+            sleep(0.05)
+            new_size = job_file.stat().st_size
+            if size and new_size == size:
+                return True
+            size = new_size
+    except FileNotFoundError:
+        return False
+    logging.info("Job file %s still being written - skipping for now", job_file)
+    return False
+
+
+class _ParamCheck(NamedTuple):
+    """Validation check for a job parameter."""
+
+    section: str
+    item: Optional[str]
+    data_type: type
+    check: str
+
+
+# checks for the same section/item must be adjacent - sections are
+# checked before the items that they contain
+_PARAM_VALIDATION = (
+    _ParamCheck("exec_params", None, dict, "is-type"),
+    _ParamCheck("exec_params", None, dict, "not-empty"),
+    _ParamCheck("papermill", None, dict, "is-type"),
+    _ParamCheck("papermill", None, dict, "not-empty"),
+    _ParamCheck("exec_params", "notebook", str, "path-exists"),
+    _ParamCheck("exec_params", "identifier", str, "key-exists"),
+)
+
+
+def _validate_params(global_args, nb_params: NotebookParams):
+    """Validate contents of parameters file."""
+    for (section, item), param_checks in groupby(
+        _PARAM_VALIDATION, key=attrgetter("section", "item")
+    ):
+        section_val = getattr(nb_params, section)
+        test_val = (section_val or {}).get(item) if item else section_val
+        for param_check in param_checks:
+            check = param_check.check
             try:
-                nb_job.run()
-            except KeyboardInterrupt:
-                logging.info("Shutdown requested")
-                break
-            except Exception as err:  # pylint: disable=broad-except
+                if not isinstance(test_val, param_check.data_type):
+                    raise TypeError(
+                        f"Failed check {section}/{item}: "
+                        f"is not expected type {param_check.data_type}."
+                    )
+
+                if check == "path-exists":
+                    if not Path(global_args.nb_path).joinpath(test_val):
+                        raise ValueError(f"Failed check {section}/{item}: {check}")
+                elif check == "key-exists":
+                    id_list = [test_val] if isinstance(test_val, str) else test_val
+                    for ident in id_list:
+                        if not (nb_params.papermill or {}).get(ident):
+                            raise ValueError(f"Failed check {section}/{item}: {check}")
+                elif check == "not-empty":
+                    if not test_val:
+                        raise ValueError(f"Failed check {section}/{item}: {check}")
+            except KeyError:
                 logging.error(
-                    "Exception while running job (notebook %s, job %s)",
-                    nb_job.input_notebook,
-                    nb_job.job_id,
-                    exc_info=err,
+                    "Validation check on parameters - missing %s.%s", section, item
                 )
-            logging.info("Job complete")
-        logging.info("Waiting for jobs %d sec", global_args.check_interval)
-        sleep(global_args.check_interval)
-
-
-_PARAM_VALIDATION = [
-    ("exec_params", None, dict, "is-type"),
-    ("exec_params", None, dict, "not-empty"),
-    ("exec_params", "notebook", str, "path-exists"),
-    ("exec_params", "identifier", str, "key-exists"),
-    ("papermill", None, dict, "is-type"),
-    ("papermill", None, dict, "not-empty"),
-]
+                raise
+            except (ValueError, TypeError) as valid_err:
+                logging.error("\n".join(valid_err.args))
+                raise
 
 
-def _validate_params(global_args, nb_params: NotebookParams):
-    """Validate contents of parameters file."""
-    param_dict = asdict(nb_params)
-    for section, item, data_type, check in _PARAM_VALIDATION:
-        try:
-            test_val = (
-                param_dict.get(section, {}).get(item)
-                if item
-                else param_dict.get(section)
-            )
+def _read_yaml(file_path: Union[str, Path]) -> Any:
+    """
+    Read and parse a YAML file.
 
-            if not isinstance(test_val, data_type):
-                raise TypeError(
-                    f"Failed check {section}/{item}: is not expected type {data_type}."
-                )
+    Notes
+    -----
+    Parsed results are cached, keyed on the file path, modification
+    time and size, so the returned object must not be modified.
+
+    """
+    file_stat = os.stat(file_path)
+    return _load_yaml_cached(str(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+
+@lru_cache(maxsize=256)
+def _load_yaml_cached(
+    file_path: str, mtime_ns: int, size: int  # pylint: disable=unused-argument
+) -> Any:
+    """Parse YAML file - `mtime_ns` is only used as a cache key."""
+    # size the read buffer to the file so that libyaml can pull
+    # the whole (undecoded) file with a single read
+    buffer_size = min(max(size, io.DEFAULT_BUFFER_SIZE), _MAX_READ_BUFFER)
+    with open(file_path, "rb", buffering=buffer_size) as yaml_file:
+        return yaml.load(yaml_file, Loader=_YamlLoader)
+
+
+def _read_cached_params(yaml_file: Path, cache_folder: Path) -> Any:
+    """
+    Read job parameters from `yaml_file`, using a cached copy if available.
+
+    Notes
+    -----
+    Parsed parameters are cached as JSON (much quicker to load than
+    YAML) in `cache_folder`, named by a hash of the YAML file contents,
+    so a job file queued again with the same contents (e.g. a copy of
+    a template) is not re-parsed. Parameters that do not round-trip
+    through JSON unchanged (e.g. dates) are not cached. Errors reading
+    or writing the cache are ignored.
+
+    """
+    yaml_bytes = yaml_file.read_bytes()
+    cache_file = cache_folder.joinpath(f"{hashlib.sha256(yaml_bytes).hexdigest()}.json")
+    try:
+        params = json.loads(cache_file.read_bytes())
+    except (OSError, ValueError):
+        params = yaml.load(yaml_bytes, Loader=_YamlLoader)
+        _write_params_cache(cache_file, params)
+        return params
+    try:
+        # mark as recently used so that it is not pruned
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return params
+
+
+def _write_params_cache(cache_file: Path, params: Any):
+    """Write `params` to `cache_file` if they round-trip through JSON."""
+    try:
+        cache_text = json.dumps(params)
+    except (TypeError, ValueError):
+        return
+    if json.loads(cache_text) != params:
+        return
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file so other workers never see a partial file
+        temp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        temp_file.write_text(cache_text, encoding="utf-8")
+        os.replace(temp_file, cache_file)
+        _prune_params_cache(cache_file.parent)
+    except OSError as err:
+        logging.warning("Could not write parameter cache %s: %s", cache_file, err)
+
+
+def _prune_params_cache(cache_folder: Path):
+    """Remove cache files that have not been used recently."""
+    global _NEXT_CACHE_PRUNE  # pylint: disable=global-statement
+    if monotonic() < _NEXT_CACHE_PRUNE:
+        return
+    _NEXT_CACHE_PRUNE = monotonic() + _PARAMS_CACHE_PRUNE_INTERVAL
+    expiry = time() - _PARAMS_CACHE_MAX_AGE
+    with os.scandir(cache_folder) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < expiry:
+                    os.unlink(entry.path)
+            except OSError:
+                # removed by another worker
+                continue
 
-            if check == "path-exists":
-                if not Path(global_args.nb_path).joinpath(test_val):
-                    raise ValueError(f"Failed check {section}/{item}: {check}")
-            elif check == "key-exists":
-                id_list = [test_val] if isinstance(test_val, str) else test_val
-                for ident in id_list:
-                    if not param_dict.get("papermill", {}).get(ident):
-                        raise ValueError(f"Failed check {section}/{item}: {check}")
-            elif check == "not-empty":
-                if not test_val:
-                    raise ValueError(f"Failed check {section}/{item}: {check}")
-        except KeyError:
-            logging.error(
-                "Validation check on parameters - missing %s.%s", section, item
-            )
-            raise
-        except (ValueError, TypeError) as valid_err:
-            logging.error("\n".join(valid_err.args))
-            raise
+
+def _job_identifier(params: Dict[str, Any]) -> str:
+    """Return the identifier for the job from the job parameters."""
+    # missing sections are reported by _validate_params
+    papermill_params = params.get("papermill") or {}
+    identifiers = (params.get("exec") or {}).get("identifier", "")
+    if isinstance(identifiers, str):
+        identifiers = [identifiers]
+    identifier = "-".join(papermill_params.get(param, "") for param in identifiers)
+    return _safe_file_name(identifier.replace("--", "-"))
 
 
 def _safe_file_name(input_name):
     """Return filename with illegal characters replaced with '-'."""
-    return re.sub(r"[<>:\"/\\|?*]", "-", input_name)
+    return input_name.translate(_UNSAFE_FN_CHARS)
 
 
 # papermill.execute.execute_notebook(
@@ -384,11 +812,15 @@ def _run_notebook(
     input_nb: Union[str, Path],
     output_nb: Union[str, Path],
     nb_params: NotebookParams,
+    kernel_reuse: int = 0,
 ):
     """Execute the notebook."""
     nb_kwargs = {
         key: val for key, val in nb_params.exec_params.items() if key in _PM_EXEC_ARGS
     }
+    if kernel_reuse and "engine_name" not in nb_kwargs:
+        nb_kwargs["engine_name"] = _KERNEL_REUSE_ENGINE
+        nb_kwargs["max_kernel_uses"] = kernel_reuse
     return pm.execute_notebook(
         input_path=input_nb,
         output_path=output_nb,
@@ -397,19 +829,163 @@ def _run_notebook(
     )
 
 
-def _notebook_to_html(nb_path):
-    """Convert a notebook to HTML."""
-    # Instantiate the exporter
-    html_exporter = HTMLExporter()
-    html_exporter.template_name = "classic"
+class KernelReuseEngine(NBClientEngine):
+    """
+    Papermill engine that runs notebooks on kernels reused between jobs.
+
+    Notes
+    -----
+    Kernels are kept in a per-process pool, keyed by kernel name.
+    Before a kernel is reused, its user namespace is cleared with
+    ``%reset -f``. Modules imported by earlier notebooks stay loaded,
+    which saves most of the kernel start-up and import time. A new kernel
+    is started if the pooled kernel has died, cannot be reset or has
+    already run `max_kernel_uses` notebooks.
+
+    """
+
+    @classmethod
+    def execute_managed_notebook(
+        cls,
+        nb_man,
+        kernel_name,
+        log_output=False,
+        stdout_file=None,
+        stderr_file=None,
+        start_timeout=60,
+        execution_timeout=None,
+        max_kernel_uses=1,
+        **kwargs,
+    ):
+        """Execute the notebook on a kernel from the kernel pool."""
+        final_kwargs = merge_kwargs(
+            remove_args(["input_path", "timeout", "startup_timeout"], **kwargs),
+            timeout=execution_timeout if execution_timeout else kwargs.get("timeout"),
+            startup_timeout=start_timeout,
+            kernel_name=kernel_name,
+            log=pm_logger,
+            log_output=log_output,
+            stdout_file=stdout_file,
+            stderr_file=stderr_file,
+        )
+        client = PapermillNotebookClient(
+            nb_man, km=_get_pooled_kernel(kernel_name, max_kernel_uses), **final_kwargs
+        )
+        try:
+            return client.execute()
+        finally:
+            # the client does not clean up a kernel that it does not own
+            if client.kc is not None:
+                client.kc.stop_channels()
+
+
+_KERNEL_REUSE_ENGINE = "kernel_reuse"
+papermill_engines.register(_KERNEL_REUSE_ENGINE, KernelReuseEngine)
+
+_KERNEL_RESET_TIMEOUT = 30
+# (kernel manager, use count) for each kernel name - per worker process
+_KERNEL_POOL: Dict[str, Tuple[KernelManager, int]] = {}
+
+
+def _get_pooled_kernel(kernel_name: str, max_uses: int) -> KernelManager:
+    """Return a running kernel for `kernel_name` from the kernel pool."""
+    if kernel_name in _KERNEL_POOL:
+        kernel_mgr, uses = _KERNEL_POOL.pop(kernel_name)
+        if uses < max_uses and kernel_mgr.is_alive() and _reset_kernel(kernel_mgr):
+            _KERNEL_POOL[kernel_name] = (kernel_mgr, uses + 1)
+            return kernel_mgr
+        logging.info("Replacing pooled %s kernel", kernel_name)
+        kernel_mgr.shutdown_kernel(now=True)
+    kernel_mgr = KernelManager(
+        kernel_name=kernel_name,
+        # nbclient expects an asynchronous kernel client
+        client_class="jupyter_client.asynchronous.AsyncKernelClient",
+    )
+    kernel_mgr.start_kernel()
+    _KERNEL_POOL[kernel_name] = (kernel_mgr, 1)
+    return kernel_mgr
+
+
+def _reset_kernel(kernel_mgr: KernelManager) -> bool:
+    """Clear the user namespace of a kernel, return False if this fails."""
+    kernel_client = BlockingKernelClient()
+    kernel_client.load_connection_info(kernel_mgr.get_connection_info())
+    kernel_client.start_channels()
+    try:
+        kernel_client.wait_for_ready(timeout=_KERNEL_RESET_TIMEOUT)
+        reply = kernel_client.execute_interactive(
+            "%reset -f",
+            store_history=False,
+            timeout=_KERNEL_RESET_TIMEOUT,
+            output_hook=lambda msg: None,
+        )
+    except (RuntimeError, TimeoutError):
+        return False
+    finally:
+        kernel_client.stop_channels()
+    return reply["content"]["status"] == "ok"
+
 
-    nb_node = nbformat.read(nb_path, as_version=4)
+def _shutdown_kernel_pool():
+    """Shut down any pooled kernels."""
+    while _KERNEL_POOL:
+        _, (kernel_mgr, _) = _KERNEL_POOL.popitem()
+        kernel_mgr.shutdown_kernel(now=True)
+
+
+# Exporter (and its template) are created once and reused for each
+# conversion - each worker process gets its own instance.
+_HTML_EXPORTER = HTMLExporter(template_name="classic")
+
+
+def _has_scrap(nb_node: nbformat.NotebookNode, name: str) -> bool:
+    """Return True if the notebook has an output for scrapbook scrap `name`."""
+    return any(
+        output.get("metadata", {}).get("scrapbook", {}).get("name") == name
+        for cell in nb_node.cells
+        for output in cell.get("outputs", [])
+    )
+
+
+def _link_or_copy(src: Path, dst: Path):
+    """Hard link `src` to `dst`, falling back to copying the file."""
+    if dst.exists():
+        if dst.samefile(src):
+            return
+        dst.unlink()
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        # e.g. different file systems or links not supported
+        pass
+    if hasattr(os, "copy_file_range"):
+        # lets the file system share blocks (reflink) where supported
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                while os.copy_file_range(
+                    src_file.fileno(), dst_file.fileno(), _COPY_CHUNK_SIZE
+                ):
+                    pass
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def _notebook_to_html(nb_path, nb_node: Optional[nbformat.NotebookNode] = None):
+    """Convert a notebook to HTML, using `nb_node` if already loaded."""
+    if nb_node is None:
+        nb_node = nbformat.read(nb_path, as_version=4)
     # Convert the notebook
-    body, _ = html_exporter.from_notebook_node(nb_node)
+    body, _ = _HTML_EXPORTER.from_notebook_node(nb_node)
 
     out_file = Path(nb_path).with_suffix(".html")
+    # write in chunks so that only one chunk at a time is held
+    # in encoded form
     with open(out_file, "w", encoding="utf-8") as nb_file:
-        nb_file.write(body)
+        for start in range(0, len(body), _HTML_CHUNK_SIZE):
+            nb_file.write(body[start : start + _HTML_CHUNK_SIZE])
 
 
 def _add_script_args(description):
@@ -470,8 +1046,26 @@ def _add_script_args(description):
     parser.add_argument(
         "--check-interval",
         "-i",
-        help=("Number of seconds to sleep between checks."),
-        default=3.0,
+        help=("Number of seconds between rescans of the queue folder."),
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        help=("Maximum number of notebook jobs to run in parallel."),
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--kernel-reuse",
+        "-k",
+        help=(
+            "Number of jobs to run on each notebook kernel before restarting it"
+            " (default 0 - start a new kernel for each job)."
+        ),
+        type=int,
+        default=0,
     )
     parser.add_argument(
         "--msticpy-config",